@@ -1,27 +1,137 @@
 import os
 import json
+import asyncio
+import argparse
+import time
+import random
+import multiprocessing
 import subprocess
 import shutil
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
 import ast
+import hashlib
+import threading
+from functools import lru_cache
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from coverage import Coverage
+
+try:
+    import tiktoken
+except ImportError:  # Token counts fall back to a character-based estimate
+    tiktoken = None
 
 # Configuration
 GIT_REPO_PATH = "path/to/your/repo"  # Replace with your Git repo path
 UNIT_TESTS_FOLDER = os.path.join(GIT_REPO_PATH, "unit_tests")
 METADATA_FILE = os.path.join(GIT_REPO_PATH, "metadata.json")
+METADATA_VERSION = 2  # Bump when the extracted metadata changes, so cached entries are not reused
 LOG_FILE = os.path.join(GIT_REPO_PATH, "test_failure_log.json")
 MAX_ITERATIONS = 3
+EXCLUDED_DIRS = {".git", ".venv", "venv", "__pycache__", "node_modules", ".tox", ".nox", ".cache", "build", "dist"}
+MAX_CONCURRENT_REQUESTS = 20
+GEN_MARKER_PREFIX = "# gen: "  # Marks each generated test with the source it was generated from
+FUNCTIONS_PER_PROMPT = 5  # Functions packed into one request, keeps responses within the output token limit
+MAX_FILE_CONTEXT_TOKENS = 4000  # Larger files are reduced to the relevant functions and their callees
+LLM_CACHE_DIR = os.path.join(GIT_REPO_PATH, ".cache", "openai")
+LLM_CACHE_ENABLED = os.environ.get("LLM_CACHE", "on").lower() != "off"  # Set LLM_CACHE=off to bypass the cache
+BATCH_INPUT_FILE = os.path.join(GIT_REPO_PATH, "batch_input.jsonl")
+BATCH_POLL_INTERVAL = 60  # Seconds between batch status checks
+
+# HTTP Configuration
+REQUEST_TIMEOUT = 300  # Seconds, generous enough for long completions
+MAX_API_ATTEMPTS = 6
+RETRY_MAX_WAIT = 30  # Upper bound in seconds for the exponential backoff
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
 
 # Azure OpenAI Configuration
 AZURE_OPENAI_API_KEY = "your-azure-openai-api-key"
 AZURE_OPENAI_ENDPOINT = "https://<your-resource-name>.openai.azure.com/"
 AZURE_OPENAI_DEPLOYMENT_NAME = "gpt-4"  # Replace with your deployment name
 AZURE_API_VERSION = "2024-05-01-preview"
+AZURE_BATCH_API_VERSION = "2024-10-21"  # The Batch API needs 2024-07-01-preview or later
+
+# Shared session so concurrent requests reuse pooled TCP/TLS connections
+_SESSION = requests.Session()
+_SESSION.mount("https://", HTTPAdapter(pool_connections=32, pool_maxsize=32))
+
+def _retry_after(response):
+    """Return the delay in seconds requested by the server's retry headers, if any."""
+    if response is None:
+        return None
+    try:
+        if "retry-after-ms" in response.headers:
+            return float(response.headers["retry-after-ms"]) / 1000
+        if "Retry-After" in response.headers:
+            return float(response.headers["Retry-After"])
+    except ValueError:
+        pass  # HTTP-date values fall back to exponential backoff
+    return None
+
+class IncompleteStreamError(Exception):
+    """A streamed completion ended before the server signalled that it was finished."""
+
+def request_with_retry(method, url, read=None, **kwargs):
+    """Send a request through the shared session, retrying transient failures with exponential backoff and jitter.
 
-def call_azure_openai(deployment_name, prompt, max_tokens=700, temperature=0.4, frequency_penalty=0.0, presence_penalty=0.0):
-    """Call Azure OpenAI API for text completion."""
+    With `read`, a 200 response is consumed by read(response) inside the retry loop, so a connection dropped
+    while streaming the body is retried as well. The call then returns (response, result), with result None
+    for any other status.
+    """
+    kwargs.setdefault("timeout", REQUEST_TIMEOUT)
+    for attempt in range(1, MAX_API_ATTEMPTS + 1):
+        response = None
+        try:
+            response = _SESSION.request(method, url, **kwargs)
+            if read is not None and response.status_code == 200:
+                return response, read(response)
+        except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError, IncompleteStreamError) as error:
+            if attempt == MAX_API_ATTEMPTS:
+                raise
+            reason = type(error).__name__
+        else:
+            # Non-retryable responses, and the last attempt, are returned for the caller to handle
+            if response.status_code not in RETRYABLE_STATUS_CODES or attempt == MAX_API_ATTEMPTS:
+                return (response, None) if read is not None else response
+            reason = response.status_code
+
+        delay = _retry_after(response) or random.uniform(0, min(RETRY_MAX_WAIT, 2 ** attempt))
+        if response is not None:
+            # Release the connection back to the pool, a streamed body is otherwise never consumed
+            response.close()
+        print(f"Request to {url} failed ({reason}), retrying in {delay:.1f}s...")
+        time.sleep(delay)
+
+def read_stream(response):
+    """Assemble a streamed chat completion from its server-sent events, returning (content, finish_reason)."""
+    chunks = []
+    finish_reason = None
+    done = False
+    with response:
+        # SSE is UTF-8 by definition, don't rely on the charset of the Content-Type header
+        for raw_line in response.iter_lines():
+            line = raw_line.decode("utf-8")
+            if not line or not line.startswith("data:"):
+                continue
+            payload = line[len("data:"):].strip()
+            if payload == "[DONE]":
+                done = True
+                break
+            event = json.loads(payload)
+            if event.get("error"):
+                raise Exception(f"Azure OpenAI stream failed: {event['error']}")
+            # Azure sends events without choices, e.g. for prompt filter results
+            for choice in event.get("choices", []):
+                chunks.append(choice.get("delta", {}).get("content") or "")
+                finish_reason = choice.get("finish_reason") or finish_reason
+    if not done or finish_reason is None:
+        raise IncompleteStreamError("Azure OpenAI stream ended before the completion finished")
+    return "".join(chunks), finish_reason
+
+def call_azure_openai(deployment_name, prompt, max_tokens=700, temperature=0.4, frequency_penalty=0.0, presence_penalty=0.0, response_format=None, read_cache=True):
+    """Call Azure OpenAI API for text completion, reusing cached responses for identical requests unless read_cache is False."""
     url = f"{AZURE_OPENAI_ENDPOINT}/openai/deployments/{deployment_name}/chat/completions?api-version={AZURE_API_VERSION}"
     headers = {
         "Content-Type": "application/json",
@@ -34,95 +144,189 @@ def call_azure_openai(deployment_name, prompt, max_tokens=700, temperature=0.4,
         "frequency_penalty": frequency_penalty,
         "presence_penalty": presence_penalty,
     }
-    response = requests.post(url, headers=headers, json=data)
-    if response.status_code == 200:
-        return response.json()["choices"][0]["message"]["content"]
-    else:
+    if response_format:
+        data["response_format"] = response_format
+
+    cache_path = None
+    if LLM_CACHE_ENABLED:
+        cache_key = hashlib.blake2b(
+            json.dumps({"deployment": deployment_name, **data}, sort_keys=True).encode("utf-8"), digest_size=16
+        ).hexdigest()
+        cache_path = os.path.join(LLM_CACHE_DIR, f"{cache_key}.txt")
+        if read_cache and os.path.exists(cache_path):
+            return Path(cache_path).read_text(encoding="utf-8")
+
+    # Stream the completion so it is received while the model is still generating
+    data["stream"] = True
+    response, result = request_with_retry("POST", url, read=read_stream, headers=headers, json=data, stream=True)
+    if result is None:
         raise Exception(f"Azure OpenAI API call failed: {response.status_code} - {response.text}")
 
-def analyze_dependencies(repo_path):
-    """Analyze interdependencies using the ast module."""
-    dependencies = {}
+    content, finish_reason = result
+    if not content.strip():
+        raise Exception(f"Azure OpenAI API returned no content (finish_reason: {finish_reason})")
+    # Only cache complete answers, truncated or filtered ones should be requested again next run
+    if cache_path and finish_reason == "stop":
+        os.makedirs(LLM_CACHE_DIR, exist_ok=True)
+        write_atomic(cache_path, content)
+    return content
 
-    # Walk through all Python files in the repository
-    for root, _, files in os.walk(repo_path):
+@lru_cache(maxsize=None)
+def _read_bytes(path):
+    """Read the raw bytes of a source file once, later calls reuse the cached content."""
+    return Path(path).read_bytes()
+
+@lru_cache(maxsize=None)
+def _read(path):
+    """Decode a source file once, later calls reuse the cached content."""
+    return _read_bytes(path).decode("utf-8")
+
+@lru_cache(maxsize=None)
+def _parse(path):
+    """Parse a source file once, later calls reuse the cached AST."""
+    return ast.parse(_read(path), filename=path)
+
+@lru_cache(maxsize=None)
+def file_hash(path):
+    """Hash the raw bytes of a file to detect files unchanged since the last run."""
+    return hashlib.blake2b(_read_bytes(path), digest_size=16).hexdigest()
+
+def write_atomic(path, content):
+    """Write text or bytes to a temporary file and rename it into place; no fsync, outputs are regenerable."""
+    # A unique temporary name keeps concurrent writers of the same path from clobbering each other
+    temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    if isinstance(content, bytes):
+        Path(temp_path).write_bytes(content)
+    else:
+        Path(temp_path).write_text(content, encoding="utf-8")
+    os.replace(temp_path, path)
+
+def load_metadata(metadata_file):
+    """Load the metadata of a previous run, or an empty dict if there is none or it has an older format."""
+    try:
+        metadata = orjson.loads(Path(metadata_file).read_bytes())
+    except (FileNotFoundError, orjson.JSONDecodeError):
+        return {}
+    return metadata if metadata.get("version") == METADATA_VERSION else {}
+
+def cached_entry(previous, section, key, relative_path, source_hash):
+    """Return an entry of the previous metadata if its file is unchanged, else None."""
+    if previous.get("hashes", {}).get(relative_path) != source_hash:
+        return None
+    return previous.get(section, {}).get(key)
+
+def iter_python_files(repo_path):
+    """Yield the Python files of the repository, without descending into EXCLUDED_DIRS."""
+    for root, dirs, files in os.walk(repo_path):
+        # Prune in place so os.walk never visits excluded trees
+        dirs[:] = [d for d in dirs if d not in EXCLUDED_DIRS]
         for file in files:
             if file.endswith(".py"):
-                file_path = os.path.join(root, file)
-                with open(file_path, "r", encoding="utf-8") as source_file:
-                    try:
-                        # Parse the file content into an AST
-                        tree = ast.parse(source_file.read(), filename=file_path)
-                        imports = []
-
-                        # Iterate over all nodes in the AST
-                        for node in ast.walk(tree):
-                            # Check for import statements
-                            if isinstance(node, ast.Import):
-                                for alias in node.names:
-                                    imports.append(alias.name)
-                            elif isinstance(node, ast.ImportFrom):
-                                if node.module:
-                                    imports.append(node.module)
-
-                        # Store the imports in the dependencies dictionary
-                        module_name = os.path.relpath(file_path, repo_path).replace(os.sep, ".")[:-3]  # Remove .py extension
-                        dependencies[module_name] = imports
-                    except SyntaxError as e:
-                        print(f"Syntax error in file {file_path}: {e}")
-                    except Exception as e:
-                        print(f"Error processing file {file_path}: {e}")
-
-    return dependencies
+                yield os.path.join(root, file)
+
+def extract_imports(file_path):
+    """Extract the top-level modules imported by a file using ast, or None if it cannot be parsed."""
+    try:
+        # Parse the file content into an AST
+        tree = _parse(file_path)
+        imports = []
+
+        # Iterate over all nodes in the AST
+        for node in ast.walk(tree):
+            # Check for import statements, keeping only the top-level package
+            if isinstance(node, ast.Import):
+                for alias in node.names:
+                    imports.append(alias.name.split(".")[0])
+            elif isinstance(node, ast.ImportFrom):
+                if node.module:
+                    imports.append(node.module.split(".")[0])
+        return list(dict.fromkeys(imports))
+    except SyntaxError as e:
+        print(f"Syntax error in file {file_path}: {e}")
+    except Exception as e:
+        print(f"Error processing file {file_path}: {e}")
+    return None
 
 def extract_function_metadata(file_path):
-    """Extract detailed function metadata using ast."""
+    """Extract detailed metadata of the top-level functions using ast."""
     metadata = []
-    with open(file_path, "r", encoding="utf-8") as source_file:
-        tree = ast.parse(source_file.read(), filename=file_path)
-        for node in ast.walk(tree):
-            if isinstance(node, ast.FunctionDef):
-                metadata.append({
-                    "name": node.name,
-                    "args": [arg.arg for arg in node.args.args],
-                    "docstring": ast.get_docstring(node),
-                })
+    tree = _parse(file_path)
+    # Only module-level definitions; methods and nested functions are tested through their owners
+    for node in tree.body:
+        if isinstance(node, ast.FunctionDef):
+            metadata.append({
+                "name": node.name,
+                "args": [arg.arg for arg in node.args.args],
+                "docstring": ast.get_docstring(node),
+            })
     return metadata
 
+def scan_file(file_path, with_functions):
+    """Parse a file once and return (imports, functions), functions being None unless requested."""
+    imports = extract_imports(file_path)
+    functions = extract_function_metadata(file_path) if with_functions else None
+    return imports, functions
+
 def create_metadata(repo_path, metadata_file):
-    """Generate metadata for the codebase."""
-    metadata = {"files": {}, "dependencies": analyze_dependencies(repo_path)}
-    for root, _, files in os.walk(repo_path):
-        for file in files:
-            if file.endswith(".py") and not file.startswith("test_"):
-                file_path = os.path.join(root, file)
-                metadata["files"][os.path.relpath(file_path, repo_path)] = extract_function_metadata(file_path)
+    """Generate metadata for the codebase, only re-parsing files changed since the last run."""
+    previous = load_metadata(metadata_file)
+    metadata = {"version": METADATA_VERSION, "files": {}, "dependencies": {}, "hashes": {}}
+    entries = {}
+    changed = {}
 
-    with open(metadata_file, "w") as file:
-        json.dump(metadata, file, indent=4)
-    print(f"Metadata created at {metadata_file}")
+    # Walk through all Python files in the repository
+    for file_path in iter_python_files(repo_path):
+        relative_path = os.path.relpath(file_path, repo_path)
+        module_name = relative_path.replace(os.sep, ".")[:-3]  # Remove .py extension
+        try:
+            source_hash = file_hash(file_path)
+        except OSError as e:
+            print(f"Error reading file {file_path}: {e}")
+            continue
+        metadata["hashes"][relative_path] = source_hash
 
-def generate_unit_tests(metadata, output_folder):
-    """Generate unit tests using Azure OpenAI."""
-    os.makedirs(output_folder, exist_ok=True)
-    for file_path, functions in metadata["files"].items():
-        with open(os.path.join(GIT_REPO_PATH, file_path), "r") as file:
-            file_content = file.read()
+        # Test files only contribute dependencies
+        with_functions = not os.path.basename(file_path).startswith("test_")
+        imports = cached_entry(previous, "dependencies", module_name, relative_path, source_hash)
+        functions = cached_entry(previous, "files", relative_path, relative_path, source_hash) if with_functions else None
+        entries[relative_path] = (module_name, imports, functions)
+        if imports is None or (with_functions and functions is None):
+            changed[relative_path] = (file_path, with_functions)
 
-        for function in functions:
-            function_name = function["name"]
-            print(f"Generating test for {function_name} in {file_path}...")
+    # Parsing is CPU-bound, so spread the changed files over all cores, parsing each one once
+    if len(changed) > 1:
+        with multiprocessing.Pool(min(os.cpu_count(), len(changed))) as pool:
+            results = pool.starmap(scan_file, changed.values())
+    else:
+        results = [scan_file(*args) for args in changed.values()]
+    for relative_path, (imports, functions) in zip(changed, results):
+        entries[relative_path] = (entries[relative_path][0], imports, functions)
+
+    for relative_path, (module_name, imports, functions) in entries.items():
+        # Files that could not be parsed have no imports entry
+        if imports is not None:
+            metadata["dependencies"][module_name] = imports
+        if functions is not None:
+            metadata["files"][relative_path] = functions
 
-            # Create a context-aware prompt with best practices
-            prompt = f"""
+    # Write atomically so an interrupted run never leaves a truncated cache behind
+    write_atomic(metadata_file, orjson.dumps(metadata, option=orjson.OPT_INDENT_2))
+    print(f"Metadata created at {metadata_file}")
+
+# Prompt templates, filled in per file and per function
+FUNCTION_PROMPT_HEADER = """
 You are an expert Python developer. Generate robust unit tests for the following function in the given file:
-- Function name: {function_name}
-- Arguments: {function['args']}
-- Docstring: {function.get('docstring', 'None')}
+- Function name: {name}
+- Arguments: {args}
+- Docstring: {docstring}
+"""
 
-Here is the full file context for reference:
-{file_content}
+FILE_PROMPT_HEADER = """
+You are an expert Python developer. Generate robust unit tests for each of the following functions in the given file:
+{function_list}
+"""
 
+BEST_PRACTICES = """
 Ensure the tests follow these best practices:
 - The Arrange-Act-Assert pattern.
 - One logical assertion per test case.
@@ -133,33 +337,373 @@ Ensure the tests follow these best practices:
 - Ensure the unit tests are well-designed, regardless of code quality.
 """
 
-            test_code = call_azure_openai(
+FILE_CONTEXT_TEMPLATE = """
+Here is the full file context for reference:
+{file_content}
+""" + BEST_PRACTICES
+
+REDUCED_CONTEXT_TEMPLATE = """
+The file is too large to include in full. Here is the source of the functions to test:
+{function_sources}
+
+Signatures of the functions they call from the same file:
+{related_symbols}
+""" + BEST_PRACTICES
+
+FILE_PROMPT_FOOTER = "\nRespond with a JSON object that maps each function name to a string containing its complete unit test code.\n"
+
+def build_prompt(function, file_context):
+    """Create a context-aware prompt with best practices for a single function."""
+    header = FUNCTION_PROMPT_HEADER.format(name=function["name"], args=function["args"], docstring=function.get("docstring"))
+    return header + file_context
+
+def build_file_prompt(functions, file_context):
+    """Create a single prompt covering several functions of the same file."""
+    function_list = json.dumps(
+        [
+            {"id": index, "name": function["name"], "args": function["args"], "docstring": function.get("docstring")}
+            for index, function in enumerate(functions, start=1)
+        ],
+        indent=2,
+    )
+    return FILE_PROMPT_HEADER.format(function_list=function_list) + file_context + FILE_PROMPT_FOOTER
+
+def parse_file_response(response_text, functions):
+    """Map a JSON response to a file prompt back to its functions, dropping anything the model skipped."""
+    try:
+        tests = json.loads(response_text)
+    except (TypeError, json.JSONDecodeError):
+        return {}
+    if not isinstance(tests, dict):
+        return {}
+    return {
+        function["name"]: tests[function["name"]]
+        for function in functions
+        if isinstance(tests.get(function["name"]), str) and tests[function["name"]].strip()
+    }
+
+@lru_cache(maxsize=None)
+def _encoding():
+    """Return the tiktoken encoding of the deployed model, falling back to cl100k_base for custom names."""
+    try:
+        return tiktoken.encoding_for_model(AZURE_OPENAI_DEPLOYMENT_NAME)
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
+
+def count_tokens(text):
+    """Count the tokens of a text, or estimate them at four characters per token without tiktoken."""
+    if tiktoken is None:
+        return len(text) // 4
+    return len(_encoding().encode(text))
+
+def build_reduced_context(file_path, functions):
+    """Build a prompt context from the source of the given functions and the signatures of the functions they call."""
+    path = os.path.join(GIT_REPO_PATH, file_path)
+    source = _read(path)
+    definitions = {}
+    for node in ast.walk(_parse(path)):
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            definitions.setdefault(node.name, node)
+
+    names = [function["name"] for function in functions if function["name"] in definitions]
+    called = {}
+    for name in names:
+        for node in ast.walk(definitions[name]):
+            if isinstance(node, ast.Call):
+                if isinstance(node.func, ast.Name):
+                    called[node.func.id] = None
+                elif isinstance(node.func, ast.Attribute):
+                    called[node.func.attr] = None
+
+    related = []
+    for name in called:
+        if name in definitions and name not in names:
+            node = definitions[name]
+            returns = f" -> {ast.unparse(node.returns)}" if node.returns else ""
+            prefix = "async def" if isinstance(node, ast.AsyncFunctionDef) else "def"
+            related.append(f"{prefix} {node.name}({ast.unparse(node.args)}){returns}")
+
+    return REDUCED_CONTEXT_TEMPLATE.format(
+        function_sources="\n\n".join(ast.get_source_segment(source, definitions[name]) for name in names),
+        related_symbols="\n".join(related) or "None",
+    )
+
+def get_test_file_path(output_folder, file_path):
+    """Return the path of the test file holding the tests of a source file."""
+    return os.path.join(output_folder, f"test_{os.path.basename(file_path)}")
+
+def gen_marker(metadata, file_path, function_name):
+    """Return the marker line identifying a function's test for the current version of its source file."""
+    return f"{GEN_MARKER_PREFIX}{file_path}:{function_name}:{metadata['hashes'][file_path]}"
+
+def load_existing_tests(output_folder):
+    """Map each previously generated test file to its {marker: test code} blocks."""
+    existing = {}
+    if not os.path.isdir(output_folder):
+        return existing
+
+    for test_file_name in os.listdir(output_folder):
+        if not (test_file_name.startswith("test_") and test_file_name.endswith(".py")):
+            continue
+        tests = {}
+        marker = None
+        for line in Path(output_folder, test_file_name).read_text(encoding="utf-8").splitlines(keepends=True):
+            if line.startswith(GEN_MARKER_PREFIX):
+                marker = line.rstrip("\n")
+                tests[marker] = ""
+            elif marker:
+                tests[marker] += line
+        # Files without markers were not generated by this script and are left alone
+        if tests:
+            existing[os.path.join(output_folder, test_file_name)] = tests
+    return existing
+
+def iter_function_chunks(metadata, existing):
+    """Yield (file_path, file_context, functions) for functions without an up-to-date test, FUNCTIONS_PER_PROMPT at a time."""
+    known_markers = {marker for tests in existing.values() for marker in tests}
+    for file_path, functions in metadata["files"].items():
+        functions = [function for function in functions if gen_marker(metadata, file_path, function["name"]) not in known_markers]
+        if not functions:
+            continue
+        file_content = _read(os.path.join(GIT_REPO_PATH, file_path))
+        if count_tokens(file_content) > MAX_FILE_CONTEXT_TOKENS:
+            # Only send the functions of each chunk and the signatures of their callees
+            for start in range(0, len(functions), FUNCTIONS_PER_PROMPT):
+                chunk = functions[start:start + FUNCTIONS_PER_PROMPT]
+                yield file_path, build_reduced_context(file_path, chunk), chunk
+            continue
+
+        # Render the large, shared part of the prompt once per file
+        file_context = FILE_CONTEXT_TEMPLATE.format(file_content=file_content)
+        for start in range(0, len(functions), FUNCTIONS_PER_PROMPT):
+            yield file_path, file_context, functions[start:start + FUNCTIONS_PER_PROMPT]
+
+def write_tests(output_folder, metadata, existing, generated):
+    """Bring the test files in line with the current functions: add new tests, drop stale ones, delete empty files."""
+    known_tests = {marker: test_code for tests in existing.values() for marker, test_code in tests.items()}
+    live = defaultdict(dict)
+    for file_path, functions in metadata["files"].items():
+        test_file_path = get_test_file_path(output_folder, file_path)
+        for function in functions:
+            marker = gen_marker(metadata, file_path, function["name"])
+            test_code = generated.get(marker, known_tests.get(marker))
+            if test_code is not None:
+                live[test_file_path][marker] = test_code
+
+    for test_file_path in live.keys() | existing.keys():
+        tests = live.get(test_file_path)
+        if not tests:
+            # The source file or all of its functions are gone
+            os.remove(test_file_path)
+            print(f"Removed stale tests {test_file_path}")
+            continue
+        if list(tests) == list(existing.get(test_file_path, {})) and not generated.keys() & tests.keys():
+            continue
+        write_atomic(test_file_path, "".join(f"{marker}\n{test_code.rstrip()}\n\n" for marker, test_code in tests.items()))
+        print(f"Tests saved to {test_file_path}")
+
+async def generate_chunks(metadata, chunks, use_cache=True):
+    """Generate tests for (file_path, file_context, functions, tests) chunks concurrently, returning {marker: test code}.
+
+    `tests` holds the answers already known for a chunk (e.g. from a batch), or None to request the chunk with a
+    packed prompt first. Functions still without a test get one request each.
+    """
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+
+    async def call(prompt, max_tokens, response_format=None):
+        async with semaphore:
+            # call_azure_openai is blocking, so run it in a worker thread
+            return await asyncio.to_thread(
+                call_azure_openai,
                 deployment_name=AZURE_OPENAI_DEPLOYMENT_NAME,
                 prompt=prompt,
-                max_tokens=700,
+                max_tokens=max_tokens,
                 temperature=0.4,
+                response_format=response_format,
+                read_cache=use_cache,
+            )
+
+    async def generate(file_path, file_context, functions, tests):
+        if tests is None:
+            print(f"Generating tests for {', '.join(function['name'] for function in functions)} in {file_path}...")
+            try:
+                response = await call(build_file_prompt(functions, file_context), 700 * len(functions), {"type": "json_object"})
+                tests = parse_file_response(response, functions)
+            except Exception as e:
+                # E.g. deployments whose model does not support response_format reject the packed request
+                print(f"Packed request for {file_path} failed: {e}")
+                tests = {}
+
+        # Fall back to one request per function for anything the model skipped
+        missing = [function for function in functions if function["name"] not in tests]
+        if missing:
+            print(f"Generating {', '.join(function['name'] for function in missing)} in {file_path} individually...")
+            retried = await asyncio.gather(
+                *(call(build_prompt(function, file_context), 700) for function in missing), return_exceptions=True
             )
+            for function, test_code in zip(missing, retried):
+                if isinstance(test_code, Exception):
+                    print(f"Failed to generate test for {function['name']} in {file_path}: {test_code}")
+                else:
+                    tests[function["name"]] = test_code
+        return {gen_marker(metadata, file_path, function["name"]): tests[function["name"]] for function in functions if function["name"] in tests}
+
+    # Make sure the thread pool is large enough for the requested concurrency
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=MAX_CONCURRENT_REQUESTS))
+    # A failing chunk must not discard the tests generated for the others
+    results = await asyncio.gather(*(generate(*chunk) for chunk in chunks), return_exceptions=True)
+    generated = {}
+    for result in results:
+        if isinstance(result, Exception):
+            print(f"Test generation failed: {result}")
+        else:
+            generated.update(result)
+    return generated
+
+async def generate_unit_tests(metadata, output_folder, use_cache=True):
+    """Generate unit tests using Azure OpenAI, dispatching one request per chunk of functions concurrently."""
+    os.makedirs(output_folder, exist_ok=True)
+
+    # Skip functions whose test was already generated from the same source
+    existing = load_existing_tests(output_folder)
+    chunks = [(*chunk, None) for chunk in iter_function_chunks(metadata, existing)]
+    if not chunks:
+        # Still prune tests of removed functions
+        write_tests(output_folder, metadata, existing, {})
+        print("All tests are up to date.")
+        return
+
+    # Save the generated tests
+    write_tests(output_folder, metadata, existing, await generate_chunks(metadata, chunks, use_cache))
+
+def submit_batch_tests(metadata, output_folder, use_cache=True):
+    """Generate unit tests through the Azure OpenAI Batch API (lower cost, up to 24h turnaround)."""
+    os.makedirs(output_folder, exist_ok=True)
+    headers = {"api-key": AZURE_OPENAI_API_KEY}
+    base_url = f"{AZURE_OPENAI_ENDPOINT.rstrip('/')}/openai"
+    params = {"api-version": AZURE_BATCH_API_VERSION}
+
+    # Step 1: Serialize every chunk of functions as one chat completion request per line
+    existing = load_existing_tests(output_folder)
+    chunks = {}
+    lines = []
+    for file_path, file_context, functions in iter_function_chunks(metadata, existing):
+        custom_id = f"{file_path}:{len(chunks)}"
+        chunks[custom_id] = (file_path, file_context, functions)
+        request = {
+            "custom_id": custom_id,
+            "method": "POST",
+            "url": "/chat/completions",
+            "body": {
+                "model": AZURE_OPENAI_DEPLOYMENT_NAME,
+                "messages": [{"role": "system", "content": build_file_prompt(functions, file_context)}],
+                "max_tokens": 700 * len(functions),
+                "temperature": 0.4,
+                "response_format": {"type": "json_object"},
+            },
+        }
+        lines.append(json.dumps(request) + "\n")
+    if not chunks:
+        # Still prune tests of removed functions
+        write_tests(output_folder, metadata, existing, {})
+        print("All tests are up to date.")
+        return
+
+    # Step 2: Upload the input file, which is only needed until the upload is done
+    write_atomic(BATCH_INPUT_FILE, "".join(lines))
+    try:
+        # Send the content as bytes so a retried upload does not re-read an exhausted file handle
+        response = request_with_retry(
+            "POST", f"{base_url}/files", params=params, headers=headers,
+            files={"file": (os.path.basename(BATCH_INPUT_FILE), Path(BATCH_INPUT_FILE).read_bytes())},
+            data={"purpose": "batch"},
+        )
+    finally:
+        os.remove(BATCH_INPUT_FILE)
+    if response.status_code not in (200, 201):
+        raise Exception(f"Batch file upload failed: {response.status_code} - {response.text}")
+    input_file_id = response.json()["id"]
+
+    # Step 3: Submit the batch job
+    response = request_with_retry(
+        "POST", f"{base_url}/batches", params=params, headers=headers,
+        json={"input_file_id": input_file_id, "endpoint": "/chat/completions", "completion_window": "24h"},
+    )
+    if response.status_code not in (200, 201):
+        raise Exception(f"Batch submission failed: {response.status_code} - {response.text}")
+    batch_id = response.json()["id"]
+    print(f"Submitted batch {batch_id}")
+
+    # Step 4: Poll until the batch reaches a terminal state
+    while True:
+        response = request_with_retry("GET", f"{base_url}/batches/{batch_id}", params=params, headers=headers)
+        if response.status_code != 200:
+            raise Exception(f"Batch status check failed: {response.status_code} - {response.text}")
+        batch = response.json()
+        if batch["status"] in ("completed", "failed", "expired", "cancelled"):
+            break
+        print(f"Batch {batch_id} is {batch['status']}, waiting...")
+        time.sleep(BATCH_POLL_INTERVAL)
+
+    if batch["status"] != "completed":
+        raise Exception(f"Batch {batch_id} did not complete: {batch['status']}")
 
-            # Save the generated test
-            test_file_name = f"test_{os.path.basename(file_path)}"
-            test_file_path = os.path.join(output_folder, test_file_name)
-            with open(test_file_path, "a") as file:
-                file.write(test_code)
-                file.write("\n\n")
-            print(f"Test saved to {test_file_path}")
+    def download(file_id):
+        response = request_with_retry("GET", f"{base_url}/files/{file_id}/content", params=params, headers=headers)
+        if response.status_code != 200:
+            raise Exception(f"Batch file download failed: {response.status_code} - {response.text}")
+        return [json.loads(line) for line in response.text.splitlines() if line.strip()]
+
+    # Requests that failed outright are only listed in the error file
+    if batch.get("error_file_id"):
+        for result in download(batch["error_file_id"]):
+            print(f"Batch request {result.get('custom_id')} failed: {result.get('error') or result.get('response')}")
+
+    # Step 5: Download the results and map them back to their functions
+    # When every request failed there is no output file, and every chunk is left to the fallback
+    responses = {}
+    for result in download(batch["output_file_id"]) if batch.get("output_file_id") else []:
+        body = (result.get("response") or {}).get("body") or {}
+        if result.get("error") or "choices" not in body:
+            print(f"Batch request {result['custom_id']} failed: {result.get('error') or body}")
+            continue
+        responses[result["custom_id"]] = body["choices"][0]["message"]["content"]
+
+    # Fall back to concurrent interactive requests for anything the batch did not answer
+    generated = asyncio.run(generate_chunks(
+        metadata,
+        [
+            (file_path, file_context, functions, parse_file_response(responses.get(custom_id), functions))
+            for custom_id, (file_path, file_context, functions) in chunks.items()
+        ],
+        use_cache,
+    ))
+    write_tests(output_folder, metadata, existing, generated)
 
 def main():
+    parser = argparse.ArgumentParser(description="Generate unit tests for a repository using Azure OpenAI.")
+    parser.add_argument("--batch", action="store_true", help="Use the Batch API instead of interactive requests.")
+    parser.add_argument(
+        "--force", action="store_true",
+        help="Regenerate all tests, even for unchanged source files, without reusing cached responses.",
+    )
+    args = parser.parse_args()
+
     # Step 1: Create Metadata
     create_metadata(GIT_REPO_PATH, METADATA_FILE)
 
     # Step 2: Load Metadata
-    with open(METADATA_FILE, "r") as file:
-        metadata = json.load(file)
+    metadata = orjson.loads(Path(METADATA_FILE).read_bytes())
 
-    # Step 3: Generate Unit Tests
-    if os.path.exists(UNIT_TESTS_FOLDER):
+    # Step 3: Generate Unit Tests, only for functions without an up-to-date test unless forced
+    if args.force and os.path.exists(UNIT_TESTS_FOLDER):
         shutil.rmtree(UNIT_TESTS_FOLDER)
-    generate_unit_tests(metadata, UNIT_TESTS_FOLDER)
+    # Forced runs skip cached responses, fresh ones are still written so the cache is refreshed
+    use_cache = not args.force
+    if args.batch:
+        submit_batch_tests(metadata, UNIT_TESTS_FOLDER, use_cache=use_cache)
+    else:
+        asyncio.run(generate_unit_tests(metadata, UNIT_TESTS_FOLDER, use_cache=use_cache))
 
 if __name__ == "__main__":
     main()